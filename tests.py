@@ -1,50 +1,175 @@
+import atexit
+import functools
 import os
 import pickle
 import shutil
-import sys
+import tempfile
+import threading
 import unittest
-import uuid
 
 from sophy import *
 
 
-DB_NAME = 'db-test'
-TEST_DIR = 'sophia-test'
+# Serializers for SerializedIndex tests, using the binary pickle protocol
+# rather than the interpreter's default.
+pickle_dumps = functools.partial(pickle.dumps,
+                                 protocol=pickle.HIGHEST_PROTOCOL)
+pickle_loads = pickle.loads
 
+# Fixed-width keys and values, formatted once at import rather than on every
+# write and read of the stability test.
+N_ROWS = 1000
+KEYS = ['k%064d' % i for i in range(N_ROWS)]
+VALUES = ['v%0256d' % i for i in range(N_ROWS)]
 
-def cleanup():
-    if os.path.exists(TEST_DIR):
-        shutil.rmtree(TEST_DIR)
+
+_schema_cache = {}
+
+
+def cached_schema(key_parts, value_parts):
+    # Build each distinct schema once, so test classes declaring the same
+    # layout share it. Parts are (IndexClass, name, *args) tuples. Only use
+    # this for class-level `databases` declarations; a test that builds or
+    # extends a schema must create its own, or it would alter every user.
+    cache_key = (key_parts, value_parts)
+    if cache_key not in _schema_cache:
+        _schema_cache[cache_key] = Schema(
+            [part[0](*part[1:]) for part in key_parts],
+            [part[0](*part[1:]) for part in value_parts])
+    return _schema_cache[cache_key]
+
+
+STRING_KV = (((StringIndex, 'key'),), ((StringIndex, 'value'),))
+STRING_U8 = (((StringIndex, 'key'),), ((U8Index, 'value'),))
+
+
+def make_test_dir(name):
+    # Keep test data on a RAM-backed filesystem when one is available, so
+    # setup and teardown are not bound by disk latency. Every fixture gets a
+    # directory of its own, so test classes can run in parallel processes.
+    base = os.environ.get('SOPHY_TEST_TMP')
+    if base is None and os.path.isdir('/dev/shm'):
+        base = '/dev/shm'
+    return tempfile.mkdtemp(prefix='sophy-%s-' % name, dir=base)
+
+
+_cleanup_threads = []
+
+
+def cleanup(path):
+    # Move the directory aside and delete it in the background, so teardown
+    # does not wait on the recursive unlink.
+    if not os.path.exists(path):
+        return
+    staging = path + '.deleted'
+    os.rename(path, staging)
+    thread = threading.Thread(target=shutil.rmtree, args=(staging, True))
+    thread.daemon = True
+    thread.start()
+    _cleanup_threads.append(thread)
+
+
+@atexit.register
+def _join_cleanup_threads():
+    for thread in _cleanup_threads:
+        thread.join()
 
 
 class BaseTestCase(unittest.TestCase):
     databases = (
-        ('main', Schema([StringIndex('key')], [StringIndex('value')])),
+        ('main', cached_schema(*STRING_KV)),
     )
 
+    @classmethod
+    def setUpClass(cls):
+        cls.env = cls.open_env()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.close_env(cls.env)
+
     def setUp(self):
-        cleanup()
-        self.env = self.create_env()
-        for name, schema in self.databases:
-            self.env.add_database(name, schema)
-        assert self.env.open()
+        # The environment is shared by every test in the class, so empty the
+        # databases rather than re-creating them.
+        for name, _ in self.databases:
+            db = self.env[name]
+            db.multi_delete(list(db.keys()))
+
+    @classmethod
+    def create_env(cls, path):
+        env = Sophia(path)
+        # Keep background compaction running, but with a single worker: idle
+        # workers sleep in 10ms steps, and close() waits for each of them.
+        env.scheduler_threads = 1
+        return env
+
+    @classmethod
+    def open_env(cls):
+        path = make_test_dir(cls.__name__)
+        try:
+            env = cls.create_env(path)
+            for name, schema in cls.databases:
+                db = env.add_database(name, schema)
+                db.sync = 0  # Test data does not need to survive a crash.
+            assert env.open()
+        except BaseException:
+            cleanup(path)
+            raise
+        return env
+
+    @classmethod
+    def close_env(cls, env):
+        try:
+            assert env.close()
+        finally:
+            cleanup(env.path)
+
+    def assertIterEqual(self, iterable, expected, msg=None):
+        # Walk both sequences in lockstep instead of materializing the
+        # iterable, stopping at the first mismatch.
+        prefix = '%s: ' % msg if msg else ''
+        sentinel = object()
+        expected = iter(expected)
+        idx = -1
+        for idx, item in enumerate(iterable):
+            exp = next(expected, sentinel)
+            if exp is sentinel:
+                self.fail('%sUnexpected item at index %s: %r' %
+                          (prefix, idx, item))
+            self.assertEqual(item, exp, '%sindex %s' % (prefix, idx))
+        exp = next(expected, sentinel)
+        if exp is not sentinel:
+            self.fail('%sMissing expected item at index %s: %r' %
+                      (prefix, idx + 1, exp))
+
+
+class PerTestEnvTestCase(BaseTestCase):
+    # For the few tests that need a pristine environment (engine statistics
+    # count deleted rows) or that close, reopen or add databases to it,
+    # create and destroy the environment around each test.
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
 
-    def tearDown(self):
-        assert self.env.close()
-        cleanup()
+    def setUp(self):
+        self.env = self.open_env()
 
-    def create_env(self):
-        return Sophia(TEST_DIR)
+    def tearDown(self):
+        self.close_env(self.env)
 
 
 class TestConfigurationStability(unittest.TestCase):
     def setUp(self):
-        cleanup()
-        self.env = Sophia(TEST_DIR)
+        self.test_dir = make_test_dir(type(self).__name__)
+        self.env = Sophia(self.test_dir)
 
     def tearDown(self):
         self.env.close()
-        cleanup()
+        cleanup(self.test_dir)
 
     def test_configuration_stability(self):
         self.env.scheduler_threads = 2
@@ -57,17 +182,15 @@ class TestConfigurationStability(unittest.TestCase):
         self.assertEqual(db.mmap, 1)
         self.assertEqual(db.sync, 1)
 
-        n = 1000
-        for i in range(n):
-            db['k%064d' % i, i] = 'v%0256d' % i
+        db.update(dict(((KEYS[i], i), VALUES[i]) for i in range(N_ROWS)))
 
-        for i in range(n):
-            self.assertEqual(db['k%064d' % i, i], 'v%0256d' % i)
+        for i in range(N_ROWS):
+            self.assertEqual(db[KEYS[i], i], VALUES[i])
 
         self.assertTrue(self.env.close())
 
         # Start fresh with new env/db objects and validate config persists.
-        env2 = Sophia(TEST_DIR)
+        env2 = Sophia(self.test_dir)
         db2 = env2.add_database('main', schema)
         self.assertTrue(env2.open())
 
@@ -78,8 +201,8 @@ class TestConfigurationStability(unittest.TestCase):
         self.assertEqual(db2.compression, 'lz4')
 
         # We can re-read the data.
-        for i in range(n):
-            self.assertEqual(db2['k%064d' % i, i], 'v%0256d' % i)
+        for i in range(N_ROWS):
+            self.assertEqual(db2[KEYS[i], i], VALUES[i])
 
         db2['kx', 0] = 'vx'
         self.assertTrue(env2.close())
@@ -91,8 +214,8 @@ class TestConfigurationStability(unittest.TestCase):
         self.assertEqual(db.compression, 'lz4')
 
         # We can re-read the data using our original db handle.
-        for i in range(n):
-            self.assertEqual(db['k%064d' % i, i], 'v%0256d' % i)
+        for i in range(N_ROWS):
+            self.assertEqual(db[KEYS[i], i], VALUES[i])
 
         self.assertEqual(db['kx', 0], 'vx')
 
@@ -106,6 +229,40 @@ class TestConfiguration(BaseTestCase):
 
 
 class TestBasicOperations(BaseTestCase):
+    # Range queries against a database holding k0..k3, as either get_range()
+    # arguments or a slice, paired with the expected results.
+    range_cases = (
+        (('k1', 'k2'), [('k1', 'v1'), ('k2', 'v2')]),
+        ((('k1',), 'k2'), [('k1', 'v1'), ('k2', 'v2')]),
+        (('k1', ('k2',)), [('k1', 'v1'), ('k2', 'v2')]),
+        ((('k1',), ('k2',)), [('k1', 'v1'), ('k2', 'v2')]),
+
+        (slice('k1', 'k2'), [('k1', 'v1'), ('k2', 'v2')]),
+        (slice('k01', 'k21'), [('k1', 'v1'), ('k2', 'v2')]),
+        (slice('k2', None), [('k2', 'v2'), ('k3', 'v3')]),
+        (slice(None, 'k1'), [('k0', 'v0'), ('k1', 'v1')]),
+        (slice('k2', 'kx'), [('k2', 'v2'), ('k3', 'v3')]),
+        (slice('a1', 'k1'), [('k0', 'v0'), ('k1', 'v1')]),
+        (slice(None, 'a1'), []),
+        (slice('z1', None), []),
+        (slice(None, None), [('k0', 'v0'), ('k1', 'v1'), ('k2', 'v2'),
+                             ('k3', 'v3')]),
+
+        (slice('k2', 'k1'), [('k2', 'v2'), ('k1', 'v1')]),
+        (slice('k21', 'k01'), [('k2', 'v2'), ('k1', 'v1')]),
+        (slice('k2', None, True), [('k3', 'v3'), ('k2', 'v2')]),
+        (slice(None, 'k1', True), [('k1', 'v1'), ('k0', 'v0')]),
+        (slice('kx', 'k2'), [('k3', 'v3'), ('k2', 'v2')]),
+        (slice('k1', 'a1'), [('k1', 'v1'), ('k0', 'v0')]),
+        (slice(None, 'a1', True), []),
+        (slice('z1', None, True), []),
+        (slice(None, None, True), [('k3', 'v3'), ('k2', 'v2'), ('k1', 'v1'),
+                                   ('k0', 'v0')]),
+
+        (slice('k1', 'k2', True), [('k2', 'v2'), ('k1', 'v1')]),
+        (slice('k2', 'k1', True), [('k2', 'v2'), ('k1', 'v1')]),
+    )
+
     def test_crud(self):
         db = self.env['main']
         vals = (('huey', 'cat'), ('mickey', 'dog'), ('zaizee', 'cat'))
@@ -133,86 +290,28 @@ class TestBasicOperations(BaseTestCase):
         db.delete('k1')
         self.assertTrue(db.get('k1') is None)
 
-    def test_iterables(self):
-        db = self.env['main']
-        for i in range(4):
-            db['k%s' % i] = 'v%s' % i
-
-        items = list(db)
-        self.assertEqual(items, [('k0', 'v0'), ('k1', 'v1'), ('k2', 'v2'),
-                                 ('k3', 'v3')])
-        self.assertEqual(list(db.items()), items)
-
-        self.assertEqual(list(db.keys()), ['k0', 'k1', 'k2', 'k3'])
-        self.assertEqual(list(db.values()), ['v0', 'v1', 'v2', 'v3'])
-        self.assertEqual(len(db), 4)
-        self.assertEqual(db.index_count, 4)
-
     def test_multi_get_set(self):
         db = self.env['main']
-        for i in range(4):
-            db['k%s' % i] = 'v%s' % i
+        db.update(dict(('k%s' % i, 'v%s' % i) for i in range(4)))
 
         self.assertEqual(db.multi_get(['k0', 'k3', 'k99']), ['v0', 'v3', None])
         self.assertEqual(db.multi_get_dict(['k0', 'k3', 'k99']),
                          {'k0': 'v0', 'k3': 'v3'})
 
         db.update(k0='v0-e', k3='v3-e', k99='v99-e')
-        self.assertEqual(list(db), [('k0', 'v0-e'), ('k1', 'v1'), ('k2', 'v2'),
-                                    ('k3', 'v3-e'), ('k99', 'v99-e')])
+        self.assertIterEqual(db, [('k0', 'v0-e'), ('k1', 'v1'), ('k2', 'v2'),
+                                  ('k3', 'v3-e'), ('k99', 'v99-e')])
 
     def test_get_range(self):
         db = self.env['main']
-        for i in range(4):
-            db['k%s' % i] = 'v%s' % i
-
-        for k1, k2 in (('k1', 'k2'), (('k1',), 'k2'), ('k1', ('k2',)),
-                       (('k1',), ('k2',))):
-            self.assertEqual(list(db.get_range(k1, k2)), [
-                ('k1', 'v1'), ('k2', 'v2')])
-
-        self.assertEqual(list(db['k1':'k2']), [('k1', 'v1'), ('k2', 'v2')])
-        self.assertEqual(list(db['k01':'k21']), [('k1', 'v1'), ('k2', 'v2')])
-        self.assertEqual(list(db['k2':]), [('k2', 'v2'), ('k3', 'v3')])
-        self.assertEqual(list(db[:'k1']), [('k0', 'v0'), ('k1', 'v1')])
-        self.assertEqual(list(db['k2':'kx']), [('k2', 'v2'), ('k3', 'v3')])
-        self.assertEqual(list(db['a1':'k1']), [('k0', 'v0'), ('k1', 'v1')])
-        self.assertEqual(list(db[:'a1']), [])
-        self.assertEqual(list(db['z1':]), [])
-        self.assertEqual(list(db[:]), [('k0', 'v0'), ('k1', 'v1'),
-                                       ('k2', 'v2'), ('k3', 'v3')])
-
-        self.assertEqual(list(db['k2':'k1']), [('k2', 'v2'), ('k1', 'v1')])
-        self.assertEqual(list(db['k21':'k01']), [('k2', 'v2'), ('k1', 'v1')])
-        self.assertEqual(list(db['k2'::True]), [('k3', 'v3'), ('k2', 'v2')])
-        self.assertEqual(list(db[:'k1':True]), [('k1', 'v1'), ('k0', 'v0')])
-        self.assertEqual(list(db['kx':'k2']), [('k3', 'v3'), ('k2', 'v2')])
-        self.assertEqual(list(db['k1':'a1']), [('k1', 'v1'), ('k0', 'v0')])
-        self.assertEqual(list(db[:'a1':True]), [])
-        self.assertEqual(list(db['z1'::True]), [])
-        self.assertEqual(list(db[::True]), [('k3', 'v3'), ('k2', 'v2'),
-                                            ('k1', 'v1'), ('k0', 'v0')])
-
-        self.assertEqual(list(db['k1':'k2':True]),
-                         [('k2', 'v2'), ('k1', 'v1')])
-        self.assertEqual(list(db['k2':'k1':True]),
-                         [('k2', 'v2'), ('k1', 'v1')])
-
-    def test_open_close(self):
-        db = self.env['main']
-        db['k1'] = 'v1'
-        db['k2'] = 'v2'
-        self.assertTrue(self.env.close())
-        self.assertTrue(self.env.open())
-        self.assertFalse(self.env.open())
+        db.update(dict(('k%s' % i, 'v%s' % i) for i in range(4)))
 
-        self.assertEqual(db['k1'], 'v1')
-        self.assertEqual(db['k2'], 'v2')
-        db['k2'] = 'v2-e'
-
-        self.assertTrue(self.env.close())
-        self.assertTrue(self.env.open())
-        self.assertEqual(db['k2'], 'v2-e')
+        for args, expected in self.range_cases:
+            if isinstance(args, slice):
+                result = db[args]
+            else:
+                result = db.get_range(*args)
+            self.assertIterEqual(result, expected, '%r' % (args,))
 
     def test_transaction(self):
         db = self.env['main']
@@ -246,43 +345,38 @@ class TestBasicOperations(BaseTestCase):
         self.assertEqual(db['k2'], 'v2')
         self.assertEqual(db['k3'], 'v3')
 
+    def _two_txns(self, db):
+        # Begin two concurrent transactions, returning each along with its
+        # transactional handle on the given database.
+        txn = self.env.transaction()
+        txn2 = self.env.transaction()
+        txn.begin()
+        txn2.begin()
+        return txn, txn2, txn[db], txn2[db]
+
     def test_multiple_transaction(self):
         db = self.env['main']
         db['k1'] = 'v1'
-        txn = self.env.transaction()
-        txn.begin()
+        txn, txn2, txn_db, txn2_db = self._two_txns(db)
 
-        txn_db = txn[db]
         txn_db['k2'] = 'v2'
         txn_db['k3'] = 'v3'
-
-        txn2 = self.env.transaction()
-        txn2.begin()
-
-        txn2_db = txn2[db]
         txn2_db['k1'] = 'v1-e'
         txn2_db['k4'] = 'v4'
 
         txn.commit()
         txn2.commit()
 
-        self.assertEqual(list(db), [('k1', 'v1-e'), ('k2', 'v2'), ('k3', 'v3'),
-                                    ('k4', 'v4')])
+        self.assertIterEqual(db, [('k1', 'v1-e'), ('k2', 'v2'), ('k3', 'v3'),
+                                  ('k4', 'v4')])
 
     def test_transaction_conflict(self):
         db = self.env['main']
         db['k1'] = 'v1'
-        txn = self.env.transaction()
-        txn.begin()
+        txn, txn2, txn_db, txn2_db = self._two_txns(db)
 
-        txn_db = txn[db]
         txn_db['k2'] = 'v2'
         txn_db['k3'] = 'v3'
-
-        txn2 = self.env.transaction()
-        txn2.begin()
-
-        txn2_db = txn2[db]
         txn2_db['k2'] = 'v2-e'
 
         # txn is not finished, waiting for concurrent txn to finish.
@@ -293,26 +387,60 @@ class TestBasicOperations(BaseTestCase):
         self.assertRaises(SophiaError, txn2.commit)
 
         # Only changes from txn are present.
-        self.assertEqual(list(db), [('k1', 'v1'), ('k2', 'v2'), ('k3', 'v3')])
+        self.assertIterEqual(db, [('k1', 'v1'), ('k2', 'v2'), ('k3', 'v3')])
 
     def test_cursor(self):
         db = self.env['main']
         db.update(k1='v1', k2='v2', k3='v3')
 
         curs = db.cursor()
-        self.assertEqual(
-            list(curs),
+        self.assertIterEqual(
+            curs,
             [('k1', 'v1'), ('k2', 'v2'), ('k3', 'v3')])
 
         curs = db.cursor(order='<')
-        self.assertEqual(
-            list(curs),
+        self.assertIterEqual(
+            curs,
             [('k3', 'v3'), ('k2', 'v2'), ('k1', 'v1')])
 
 
+class TestIterables(PerTestEnvTestCase):
+    def test_iterables(self):
+        db = self.env['main']
+        db.update(dict(('k%s' % i, 'v%s' % i) for i in range(4)))
+
+        items = list(db)
+        self.assertEqual(items, [('k0', 'v0'), ('k1', 'v1'), ('k2', 'v2'),
+                                 ('k3', 'v3')])
+        self.assertIterEqual(db.items(), items)
+
+        self.assertIterEqual(db.keys(), ['k0', 'k1', 'k2', 'k3'])
+        self.assertIterEqual(db.values(), ['v0', 'v1', 'v2', 'v3'])
+        self.assertEqual(len(db), 4)
+        self.assertEqual(db.index_count, 4)
+
+
+class TestOpenClose(PerTestEnvTestCase):
+    def test_open_close(self):
+        db = self.env['main']
+        db['k1'] = 'v1'
+        db['k2'] = 'v2'
+        self.assertTrue(self.env.close())
+        self.assertTrue(self.env.open())
+        self.assertFalse(self.env.open())
+
+        self.assertEqual(db['k1'], 'v1')
+        self.assertEqual(db['k2'], 'v2')
+        db['k2'] = 'v2-e'
+
+        self.assertTrue(self.env.close())
+        self.assertTrue(self.env.open())
+        self.assertEqual(db['k2'], 'v2-e')
+
+
 class TestGetRangeNormalizeValues(BaseTestCase):
     databases = (
-        ('single_u', Schema(StringIndex('key'), U8Index('value'))),
+        ('single_u', cached_schema(*STRING_U8)),
         ('single_b', Schema(BytesIndex('key'), U8Index('value'))),
         ('multi_u', Schema([StringIndex('k0'), StringIndex('k1')],
                            [U8Index('value')])),
@@ -322,36 +450,44 @@ class TestGetRangeNormalizeValues(BaseTestCase):
                             [U8Index('value')])),
     )
 
-    def test_get_range_normalized_single(self):
-        def assertRange(db, start, stop, exp):
-            self.assertEqual([v for _, v in db.get_range(start, stop)], exp)
+    single_dbs = ('single_u', 'single_b')
+    multi_dbs = ('multi_u', 'multi_b', 'multi_ub')
 
-        for db_name in ('single_u', 'single_b'):
-            db = self.env[db_name]
-            for i in range(10):
-                db['k%s' % i] = i
+    @classmethod
+    def setUpClass(cls):
+        super(TestGetRangeNormalizeValues, cls).setUpClass()
+        for name in cls.single_dbs:
+            cls.env[name].update(dict(('k%s' % i, i) for i in range(10)))
+        for name in cls.multi_dbs:
+            cls.env[name].update(dict((('k%s' % i, 'x%s' % i), i)
+                                      for i in range(10)))
 
-            assertRange(db, 'k2', 'k45', [2, 3, 4])
-            assertRange(db, b'k2', b'k45', [2, 3, 4])
+    def setUp(self):
+        # The tests only read, so keep the data loaded by setUpClass.
+        pass
 
-    def test_get_range_normalized_multi(self):
-        def assertRange(db, start, stop, exp):
-            self.assertEqual([v for _, v in db.get_range(start, stop)], exp)
+    def assertRange(self, db, start, stop, exp):
+        self.assertEqual([v for _, v in db.get_range(start, stop)], exp,
+                         'database %s' % db.name)
 
-        for db_name in ('multi_u', 'multi_b', 'multi_ub'):
+    def test_get_range_normalized_single(self):
+        for db_name in self.single_dbs:
             db = self.env[db_name]
-            for i in range(10):
-                db['k%s' % i, 'x%s' % i] = i
+            self.assertRange(db, 'k2', 'k45', [2, 3, 4])
+            self.assertRange(db, b'k2', b'k45', [2, 3, 4])
 
-            assertRange(db, ('k2', 'x2'), ('k45', 'x45'), [2, 3, 4])
-            assertRange(db, (b'k2', b'x2'), (b'k45', b'x45'), [2, 3, 4])
-            assertRange(db, (b'k2', 'x2'), (b'k45', 'x45'), [2, 3, 4])
-            assertRange(db, ('k2', b'x2'), ('k45', b'x45'), [2, 3, 4])
+    def test_get_range_normalized_multi(self):
+        for db_name in self.multi_dbs:
+            db = self.env[db_name]
+            self.assertRange(db, ('k2', 'x2'), ('k45', 'x45'), [2, 3, 4])
+            self.assertRange(db, (b'k2', b'x2'), (b'k45', b'x45'), [2, 3, 4])
+            self.assertRange(db, (b'k2', 'x2'), (b'k45', 'x45'), [2, 3, 4])
+            self.assertRange(db, ('k2', b'x2'), ('k45', b'x45'), [2, 3, 4])
 
 
 class TestValidation(BaseTestCase):
     databases = (
-        ('single', Schema(StringIndex('key'), U8Index('value'))),
+        ('single', cached_schema(*STRING_U8)),
         ('multi', Schema((U8Index('k1'), StringIndex('k2')),
                          (U8Index('v1'), StringIndex('v2')))),
     )
@@ -363,10 +499,11 @@ class TestValidation(BaseTestCase):
         db.set('k3', (3,))
         db.set(('k4',), (4,))
         for i in range(1, 5):
-            self.assertTrue(db.exists('k%s' % i))
-            self.assertTrue(db.exists(('k%s' % i,)))
-            self.assertEqual(db.get('k%s' % i), i)
-            self.assertEqual(db.get(('k%s' % i,)), i)
+            key = 'k%s' % i
+            self.assertTrue(db.exists(key))
+            self.assertTrue(db.exists((key,)))
+            self.assertEqual(db.get(key), i)
+            self.assertEqual(db.get((key,)), i)
 
         # Invalid key- and value-lengths.
         self.assertRaises(ValueError, db.set, ('k1', 1), 100)
@@ -425,12 +562,12 @@ class TestCursorOptions(BaseTestCase):
         db = self.env['main']
 
         k_tmpl = 'log:%08x:%08x:record%s'
-        for i in range(16):
-            db[k_tmpl % (i, i, i)] = i
+        log_keys = [k_tmpl % (i, i, i) for i in range(16)]
+        db.update(dict((key, i) for i, key in enumerate(log_keys)))
 
         def assertCursor(cursor, indexes):
-            self.assertEqual(list(cursor), [
-                (k_tmpl % (i, i, i), i) for i in indexes])
+            self.assertIterEqual(cursor, [
+                (log_keys[i], i) for i in indexes])
 
         # Default ordering.
         assertCursor(db.cursor(), range(16))
@@ -448,7 +585,7 @@ class TestCursorOptions(BaseTestCase):
                      reversed(range(16)))
 
         # Use the following key as a starting-point.
-        key = k_tmpl % (12, 12, 12)
+        key = log_keys[12]
 
         # Iterate up from log:0000000c:0000000c:recordc (inclusive).
         assertCursor(db.cursor(prefix='log:', key=key), range(12, 16))
@@ -466,13 +603,15 @@ class TestCursorOptions(BaseTestCase):
         db = self.env['secondary']
         ka_tmpl = 'log:%08x'
         kb_tmpl = 'evt:%08x'
-        for i in range(4):
-            for j in range(4):
-                db[ka_tmpl % i, kb_tmpl % j] = (4 * i) + j
+        ka_list = [ka_tmpl % i for i in range(4)]
+        kb_list = [kb_tmpl % j for j in range(4)]
+        db.update(dict(((ka, kb), (4 * i) + j)
+                       for i, ka in enumerate(ka_list)
+                       for j, kb in enumerate(kb_list)))
 
         def assertCursor(cursor, indexes):
-            self.assertEqual(list(cursor), [
-                ((ka_tmpl % (i // 4), kb_tmpl % (i % 4)), i) for i in indexes])
+            self.assertIterEqual(cursor, [
+                ((ka_list[i // 4], kb_list[i % 4]), i) for i in indexes])
 
         # Default and reverse ordering.
         assertCursor(db.cursor(), range(16))
@@ -484,8 +623,8 @@ class TestCursorOptions(BaseTestCase):
         assertCursor(db.cursor(order='<=', prefix='log:', key=('m', '')),
                      reversed(range(16)))
 
-        ka = ka_tmpl % 2
-        kb = kb_tmpl % 2
+        ka = ka_list[2]
+        kb = kb_list[2]
         for prefix in (None, 'log:'):
             assertCursor(db.cursor(prefix=prefix, key=(ka, kb)), range(10, 16))
             assertCursor(db.cursor(prefix=prefix, key=(ka, kb), order='>'),
@@ -505,8 +644,8 @@ class TestCursorOptions(BaseTestCase):
 
 class TestMultipleDatabases(BaseTestCase):
     databases = (
-        ('main', Schema([StringIndex('key')], [StringIndex('value')])),
-        ('secondary', Schema([StringIndex('key')], [StringIndex('value')])),
+        ('main', cached_schema(*STRING_KV)),
+        ('secondary', cached_schema(*STRING_KV)),
     )
 
     def test_multiple_databases(self):
@@ -521,8 +660,8 @@ class TestMultipleDatabases(BaseTestCase):
         self.assertRaises(KeyError, lambda: main['k1'])
         self.assertRaises(KeyError, lambda: scnd['k2'])
 
-        self.assertEqual(list(main), [('k2', 'v2'), ('k3', 'v3')])
-        self.assertEqual(list(scnd), [('k1', 'v1_2'), ('k3', 'v3_2')])
+        self.assertIterEqual(main, [('k2', 'v2'), ('k3', 'v3')])
+        self.assertIterEqual(scnd, [('k1', 'v1_2'), ('k3', 'v3_2')])
 
     def test_multiple_db_txn(self):
         main = self.env['main']
@@ -541,8 +680,8 @@ class TestMultipleDatabases(BaseTestCase):
             del t_scnd['k2']
             t_scnd['k1'] = 'v1_2-e'
 
-        self.assertEqual(list(main), [('k2', 'v2-e'), ('k3', 'v3')])
-        self.assertEqual(list(scnd), [('k1', 'v1_2-e')])
+        self.assertIterEqual(main, [('k2', 'v2-e'), ('k3', 'v3')])
+        self.assertIterEqual(scnd, [('k1', 'v1_2-e')])
 
         with self.env.transaction() as txn:
             t_main = txn[main]
@@ -555,13 +694,27 @@ class TestMultipleDatabases(BaseTestCase):
             t_main['k3'] = 'v3-e'
             t_scnd['k2'] = 'v2_2-e'
 
-        self.assertEqual(list(main), [('k2', 'v2-e'), ('k3', 'v3-e')])
-        self.assertEqual(list(scnd), [('k1', 'v1_2-e'), ('k2', 'v2_2-e')])
+        self.assertIterEqual(main, [('k2', 'v2-e'), ('k3', 'v3-e')])
+        self.assertIterEqual(scnd, [('k1', 'v1_2-e'), ('k2', 'v2_2-e')])
+
+
+class TestMultipleDatabasesOpenClose(PerTestEnvTestCase):
+    databases = (
+        ('main', cached_schema(*STRING_KV)),
+        ('secondary', cached_schema(*STRING_KV)),
+    )
 
     def test_open_close(self):
         self.assertTrue(self.env.close())
         self.assertTrue(self.env.open())
 
+
+class TestAddDatabase(PerTestEnvTestCase):
+    databases = (
+        ('main', cached_schema(*STRING_KV)),
+        ('secondary', cached_schema(*STRING_KV)),
+    )
+
     def test_add_db(self):
         schema = Schema([StringIndex('key')], [StringIndex('value')])
         self.assertRaises(SophiaError, self.env.add_database, 'db-3', schema)
@@ -596,6 +749,12 @@ class TestMultiKeyValue(BaseTestCase):
         ((2017, 5, 1, 'birthday'), ('private', 'mickey')),
     )
 
+    @classmethod
+    def setUpClass(cls):
+        super(TestMultiKeyValue, cls).setUpClass()
+        cls.sorted_test_data = sorted(cls.test_data)
+        cls.test_data_dict = dict(cls.test_data)
+
     def setUp(self):
         super(TestMultiKeyValue, self).setUp()
         self.db = self.env['main']
@@ -614,15 +773,15 @@ class TestMultiKeyValue(BaseTestCase):
         for key, value in self.test_data:
             self.db[key] = value
 
-        self.assertEqual(list(self.db), sorted(self.test_data))
-        self.assertEqual(list(self.db.items()), sorted(self.test_data))
-        self.assertEqual(list(self.db.keys()),
-                         sorted(key for key, _ in self.test_data))
-        self.assertEqual(list(self.db.values()),
-                         [value for _, value in sorted(self.test_data)])
+        self.assertIterEqual(self.db, self.sorted_test_data)
+        self.assertIterEqual(self.db.items(), self.sorted_test_data)
+        self.assertIterEqual(self.db.keys(),
+                             [key for key, _ in self.sorted_test_data])
+        self.assertIterEqual(self.db.values(),
+                             [value for _, value in self.sorted_test_data])
 
     def test_update_multiget(self):
-        self.db.update(dict(self.test_data))
+        self.db.update(self.test_data_dict)
         events = ((2017, 1, 1, 'holiday'),
                   (2017, 12, 25, 'holiday'),
                   (2017, 7, 1, 'birthday'))
@@ -636,33 +795,38 @@ class TestMultiKeyValue(BaseTestCase):
             (2017, 7, 1, 'birthday'): ('private', 'huey')})
 
     def test_ranges(self):
-        self.db.update(dict(self.test_data))
+        self.db.update(self.test_data_dict)
         items = self.db[(2017, 2, 1, ''):(2017, 6, 1, '')]
-        self.assertEqual(list(items), [
+        self.assertIterEqual(items, [
             ((2017, 5, 1, 'birthday'), ('private', 'mickey')),
             ((2017, 5, 29, 'holiday'), ('us', 'memorial day'))])
 
         items = self.db[:(2017, 2, 1, '')]
-        self.assertEqual(list(items), [
+        self.assertIterEqual(items, [
             ((2017, 1, 1, 'holiday'), ('us', 'new years'))])
 
         items = self.db[(2017, 11, 1, '')::True]
-        self.assertEqual(list(items), [
+        self.assertIterEqual(items, [
             ((2017, 12, 25, 'holiday'), ('us', 'christmas')),
             ((2017, 11, 23, 'holiday'), ('us', 'thanksgiving'))])
 
     def test_rev_indexes(self):
         nums = self.env['numbers']
-        for i in range(100):
-            key, v1, v2, v3, v4, v5 = range(i, 6 + i)
-            nums[key] = (v1, v2, v3, v4, v5)
+        nums.update(dict((i, (i + 1, i + 2, i + 3, i + 4, i + 5))
+                         for i in range(100)))
 
         self.assertEqual(len(nums), 100)
         self.assertEqual(nums[0], (1, 2, 3, 4, 5))
         self.assertEqual(nums[99], (100, 101, 102, 103, 104))
 
-        self.assertEqual(list(nums[:2]), [])
-        self.assertEqual(list(nums[2:]), [
+        # Overwriting a single row replaces its value in place.
+        nums[50] = (0, 0, 0, 0, 0)
+        self.assertEqual(nums[50], (0, 0, 0, 0, 0))
+        self.assertEqual(len(nums), 100)
+        nums[50] = (51, 52, 53, 54, 55)
+
+        self.assertIterEqual(nums[:2], [])
+        self.assertIterEqual(nums[2:], [
             (2, (3, 4, 5, 6, 7)),
             (1, (2, 3, 4, 5, 6)),
             (0, (1, 2, 3, 4, 5))])
@@ -686,7 +850,7 @@ class TestEventSchema(BaseTestCase):
     databases = (
         ('main',
          Schema([U64Index('timestamp'), StringIndex('type')],
-                [SerializedIndex('data', pickle.dumps, pickle.loads)])),
+                [SerializedIndex('data', pickle_dumps, pickle_loads)])),
     )
 
     def setUp(self):
@@ -710,14 +874,14 @@ class TestEventSchema(BaseTestCase):
         start = (ts(1), '')
         stop = (ts(3), '')
         data = self.db.get_range(start=start, stop=stop)
-        self.assertEqual(list(data), [
+        self.assertIterEqual(data, [
             ((ts(1), 'init'), {'msg': 'starting up'}),
             ((ts(2), 'info'), {'msg': 'info1'}),
         ])
 
         stop = (ts(4), 'f')
         data = self.db.get_range(start=start, stop=stop, reverse=True)
-        self.assertEqual(list(data), [
+        self.assertIterEqual(data, [
             ((ts(4), 'error'), {'msg': 'error1'}),
             ((ts(3), 'warning'), {'msg': 'warn1'}),
             ((ts(3), 'info'), {'msg': 'info2'}),
@@ -726,10 +890,10 @@ class TestEventSchema(BaseTestCase):
         ])
 
         curs = self.db.cursor(order='<', key=(ts(3), 'info'), values=False)
-        self.assertEqual(list(curs), [(ts(2), 'info'), (ts(1), 'init')])
+        self.assertIterEqual(curs, [(ts(2), 'info'), (ts(1), 'init')])
 
         curs = self.db.cursor(order='>=', key=(ts(3), 'info'), values=False)
-        self.assertEqual(list(curs), [
+        self.assertIterEqual(curs, [
             (ts(3), 'info'),
             (ts(3), 'warning'),
             (ts(4), 'error'),
@@ -751,13 +915,12 @@ class TestMultiKeyValue(BaseTestCase):
         self.db = self.env['main']
 
     def test_cursor_ops(self):
-        for i in range(10):
-            for j in range(5):
-                for k in range(3):
-                    self.db[i, j, k] = i * j * k
+        keys = [(i, j, k) for i in range(10) for j in range(5)
+                for k in range(3)]
+        self.db.update(dict((key, key[0] * key[1] * key[2]) for key in keys))
 
         data = self.db[(3, 3, 0):(4, 2, 1)]
-        self.assertEqual(list(data), [
+        self.assertIterEqual(data, [
             ((3, 3, 0), 0),
             ((3, 3, 1), 9),
             ((3, 3, 2), 18),
@@ -783,31 +946,29 @@ class TestMultiKeyValue(BaseTestCase):
         db['c', 9] = 5
         db['c', 3] = 6
 
-        data = list(db[(b'b', 0):(b'\xff', 5)])
-        self.assertEqual(data, [
+        data = db[(b'b', 0):(b'\xff', 5)]
+        self.assertIterEqual(data, [
             ((b'b', 0), 3),
             ((b'b', 1), 2),
             ((b'c', 3), 6),
             ((b'c', 9), 5),
             ((b'd', 0), 4)])
 
-        data = list(db[(b'\x00', 0):(b'b', 5)])
-        self.assertEqual(data, [
+        data = db[(b'\x00', 0):(b'b', 5)]
+        self.assertIterEqual(data, [
             ((b'a', 0), 1),
             ((b'b', 0), 3),
             ((b'b', 1), 2)])
 
-        data = list(db[(b'bb', 0):(b'cc', 5)])
-        self.assertEqual(data, [
+        data = db[(b'bb', 0):(b'cc', 5)]
+        self.assertIterEqual(data, [
             ((b'c', 3), 6),
             ((b'c', 9), 5)])
 
 
 class TestStringVsBytes(BaseTestCase):
     databases = (
-        ('string',
-         Schema([StringIndex('key')],
-                [StringIndex('value')])),
+        ('string', cached_schema(*STRING_KV)),
         ('bytes',
          Schema([BytesIndex('key')],
                 [BytesIndex('value')])),
@@ -838,7 +999,7 @@ class TestSerializedIndex(BaseTestCase):
     databases = (
         ('main',
          Schema(StringIndex('key'),
-                SerializedIndex('value', pickle.dumps, pickle.loads))),
+                SerializedIndex('value', pickle_dumps, pickle_loads))),
     )
 
     def setUp(self):
@@ -855,8 +1016,8 @@ class TestSerializedIndex(BaseTestCase):
         self.assertTrue(self.db['k3'] is None)
         self.assertRaises(KeyError, lambda: self.db['k4'])
 
-        data = list(self.db['k1':'k2'])
-        self.assertEqual(data, [
+        data = self.db['k1':'k2']
+        self.assertIterEqual(data, [
             ('k1', 'v1'),
             ('k2', {'foo': 'bar', 'baz': 1})])
 
@@ -886,8 +1047,8 @@ class TestSerializedIndexImplementations(BaseTestCase):
         self.assertTrue(db['k3'] is None)
         self.assertRaises(KeyError, lambda: db['k4'])
 
-        data = list(db['k1':'k2'])
-        self.assertEqual(data, [
+        data = db['k1':'k2']
+        self.assertIterEqual(data, [
             ('k1', 'v1'),
             ('k2', {'foo': 'bar', 'baz': 1})])
 
@@ -898,6 +1059,7 @@ class TestSerializedIndexImplementations(BaseTestCase):
         self._do_test(self.pdb)
 
     def test_uuid(self):
+        import uuid
         u1 = uuid.uuid4()
         u2 = uuid.uuid4()
 
@@ -912,4 +1074,4 @@ class TestSerializedIndexImplementations(BaseTestCase):
 
 
 if __name__ == '__main__':
-    unittest.main(argv=sys.argv)
+    unittest.main()